@@ -0,0 +1,119 @@
+import re
+
+import structlog
+
+
+# Logging is configured by cx_support_agent
+logger = structlog.get_logger(__name__)
+
+
+# Agent artifacts and placeholders removed from LLM output by strip_artifacts, in a single pass
+ARTIFACTS_RE = re.compile(
+    r'(?P<final_start>^\s*Final Answer:\s*)'
+    r'|(?P<final_mid>\n\s*Final Answer:\s*)'
+    r'|(?P<bad_email>\[email protected\])',
+    re.IGNORECASE
+)
+ARTIFACT_REPLACEMENTS = {
+    "final_start": "",
+    "final_mid": "\n",
+    "bad_email": "the correct email address",
+}
+BAD_EMAIL_RE = re.compile(r'\[email protected\]', re.IGNORECASE)  # Mid-line artifacts when streaming
+
+
+
+
+def strip_artifacts(output: str, query_id: str, conversation_id: str = None) -> str:
+    """Post-process to remove agent artifacts and invalid placeholders"""
+    logger.debug("Original output before stripping", output=output, query_id=query_id, conversation_id=conversation_id or "N/A")
+    try:
+        output = ARTIFACTS_RE.sub(lambda m: ARTIFACT_REPLACEMENTS[m.lastgroup], output).strip()
+        logger.debug("Stripped output", output=output, query_id=query_id, conversation_id=conversation_id or "N/A")
+        return output
+    except Exception as e:
+        logger.error("Error stripping artifacts", error=str(e), query_id=query_id, conversation_id=conversation_id or "N/A")
+        return output
+
+
+
+
+class ArtifactStreamFilter:
+    """Incremental counterpart of strip_artifacts for streamed LLM output.
+
+    Only text that could still change is held back: the start of a line while it may turn
+    into "Final Answer:", trailing whitespace (the answer is stripped at the end) and a
+    trailing partial "[email protected]" placeholder.
+    """
+
+    FINAL_ANSWER = "final answer:"
+    BAD_EMAIL = "[email protected]"
+
+    def __init__(self):
+        self._pending = ""
+        self._held = ""  # Replacement for a removed "Final Answer:", emitted before the next content
+        self._at_stream_start = True
+        self._at_line_start = True
+        self._skip_whitespace = False
+
+    def feed(self, chunk: str) -> str:
+        """Add a streamed chunk and return the text that is safe to emit"""
+        self._pending += chunk
+        out = []
+        while self._pending:
+            if self._at_line_start:
+                body = self._pending.lstrip()
+                if body[:len(self.FINAL_ANSWER)].lower() == self.FINAL_ANSWER:
+                    # Drop the artifact and the whitespace after the line break
+                    self._held = "" if self._at_stream_start else self._pending[:self._pending.find("\n") + 1]
+                    self._pending = body[len(self.FINAL_ANSWER):]
+                    self._skip_whitespace = True
+                elif len(body) < len(self.FINAL_ANSWER) and self.FINAL_ANSWER.startswith(body.lower()):
+                    break  # Could still become "Final Answer:"; wait for more text
+                else:
+                    if not self._at_stream_start:
+                        out.append(self._pending[:len(self._pending) - len(body)])
+                    self._pending = body
+                self._at_stream_start = False
+                self._at_line_start = False
+                continue
+
+            if self._skip_whitespace:
+                self._pending = self._pending.lstrip()
+                if not self._pending:
+                    break
+                self._skip_whitespace = False
+
+            content_end = len(self._pending.rstrip())
+            if not content_end:
+                break
+            newline = self._pending.find("\n", 0, content_end)
+            if newline != -1:
+                line_end = len(self._pending[:newline].rstrip())
+                out.append(self._held + BAD_EMAIL_RE.sub("the correct email address", self._pending[:line_end]))
+                self._held = ""
+                self._pending = self._pending[line_end:]
+                self._at_line_start = True
+                continue
+
+            # Hold back a trailing partial placeholder until it completes or diverges
+            cut = content_end
+            bracket = self._pending.rfind("[", 0, content_end)
+            if bracket != -1 and self.BAD_EMAIL.startswith(self._pending[bracket:content_end].lower()):
+                cut = bracket
+            if cut:
+                out.append(self._held + BAD_EMAIL_RE.sub("the correct email address", self._pending[:cut]))
+                self._held = ""
+                self._pending = self._pending[cut:]
+            break
+        return "".join(out)
+
+    def flush(self) -> str:
+        """Return whatever is still held back once the stream has ended"""
+        pending, self._pending = self._pending, ""
+        if self._at_stream_start or self._skip_whitespace:
+            pending = pending.lstrip()
+        pending = pending.rstrip()
+        if not pending:
+            return ""
+        return self._held + BAD_EMAIL_RE.sub("the correct email address", pending)
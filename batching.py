@@ -0,0 +1,78 @@
+import asyncio
+from typing import Any, Awaitable, Callable, List, Optional, Tuple
+
+import structlog
+
+
+# Logging is configured by cx_support_agent
+logger = structlog.get_logger(__name__)
+
+
+
+
+class MicroBatcher:
+    """Coalesce concurrent requests from independent queries into one batched dispatch.
+
+    Each batch is dispatched in its own task, so the next batch is collected (and dispatched)
+    while earlier ones are still in flight. An idle batcher dispatches at once: waiting up to
+    max_wait for companions only pays off while another batch is in flight.
+    """
+
+    def __init__(self, name: str, dispatch: Callable[[List[Any]], Awaitable[List[Any]]], max_size: int, max_wait: float):
+        self.name = name
+        self.dispatch = dispatch  # Maps a list of items to a list of results or exceptions
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._in_flight: set = set()  # Strong references to running dispatch tasks
+
+    async def submit(self, item: Any) -> Any:
+        """Queue an item and wait for its result"""
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    async def _collect(self) -> List[Tuple[Any, asyncio.Future]]:
+        """Wait for one item and take whatever else is queued; under load, gather more until the
+        batch is full or max_wait elapses"""
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        while len(batch) < self.max_size and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        if not self._in_flight:
+            return batch
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self) -> None:
+        while True:
+            batch = await self._collect()
+            task = asyncio.create_task(self._dispatch(batch))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _dispatch(self, batch: List[Tuple[Any, asyncio.Future]]) -> None:
+        logger.debug("Dispatching batch", batcher=self.name, batch_size=len(batch), query_id="N/A", conversation_id="N/A")
+        try:
+            results = await self.dispatch([item for item, _ in batch])
+        except Exception as e:
+            results = [e] * len(batch)
+        for (_, future), result in zip(batch, results):
+            if future.done():  # Caller went away
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
@@ -3,14 +3,25 @@ from langchain_core.runnables import RunnableLambda
 from langchain_core.output_parsers import StrOutputParser
 from langchain.memory import ConversationBufferWindowMemory
 from prompts import rag_prompt
+from artifacts import ArtifactStreamFilter, strip_artifacts
+from batching import MicroBatcher
 from new_content import get_retriever
 from dotenv import load_dotenv
+import functools
 import logging
-import uuid
+import secrets
 import re
 import os
-from typing import Optional, Dict
+import threading
+import numpy as np
+import orjson
+import structlog
+import tiktoken
+from cachetools import LRUCache, TTLCache
+from typing import Any, AsyncIterator, Callable, Optional, Dict, List, Tuple, FrozenSet
+from langchain_core.documents import Document
 from langchain_core.exceptions import LangChainException
+from pydantic import PrivateAttr
 
 
 
@@ -19,16 +30,97 @@ from langchain_core.exceptions import LangChainException
 DOMAIN_INSTRUCTIONS = ""  # Default empty; set via /set_config
 
 
-# Dictionary to store memories per conversation
-memories: Dict[str, ConversationBufferWindowMemory] = {}
+# Bounded, expiring stores for per-conversation state; idle conversations are evicted after
+# CONVERSATION_TTL_SECONDS and the least recently used beyond MAX_CONVERSATIONS are dropped.
+# TTLCache is not thread-safe, so every access goes through _conversations_lock.
+MAX_CONVERSATIONS = int(os.getenv("MAX_CONVERSATIONS", "10000"))
+CONVERSATION_TTL_SECONDS = int(os.getenv("CONVERSATION_TTL_SECONDS", "3600"))
+_conversations_lock = threading.Lock()
 
 
+# Memories per conversation, keyed by conversation ID
+memories: TTLCache = TTLCache(maxsize=MAX_CONVERSATIONS, ttl=CONVERSATION_TTL_SECONDS)
 
 
-# Set up logging with detailed format
-# Set up logging with detailed format
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+# Shared vector store retriever, built lazily on first use
+_retriever = None
+
+
+# Retrieval results per normalized query string: (normalized embedding, docs).
+# Valid while the corpus is unchanged; cleared via clear_retrieval_cache() on every corpus change,
+# which also bumps _corpus_generation so retrievals started before the change don't refill it.
+RETRIEVAL_CACHE_MAX_ENTRIES = int(os.getenv("RETRIEVAL_CACHE_MAX_ENTRIES", "10000"))
+_retrieval_cache: LRUCache = LRUCache(maxsize=RETRIEVAL_CACHE_MAX_ENTRIES)
+_retrieval_cache_lock = threading.Lock()
+_corpus_generation = 0
+
+
+# Semantic answer cache for opening questions (no chat history yet), shared across conversations.
+# Later turns depend on the history, which never recurs, so they are not cached. Entries are
+# grouped by the domain instructions the answer was generated with.
+SEMANTIC_CACHE_THRESHOLD = 0.95  # Minimum cosine similarity to reuse a cached answer
+GROUNDING_THRESHOLD = 0.5  # Minimum Jaccard overlap between cached and fresh retrieval doc ids
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "1000"))  # Per group; oldest replaced first
+_answer_cache: LRUCache = LRUCache(maxsize=8)  # Domain instructions -> SemanticCacheBucket
+_answer_cache_lock = threading.Lock()
+
+
+# Micro-batching of concurrent LLM calls: a batch is dispatched once it holds
+# LLM_BATCH_MAX_SIZE prompts or LLM_BATCH_MAX_WAIT seconds after its first prompt arrived.
+# Off by default: OpenAI's chat endpoint takes one prompt per request, so batching only adds
+# wait time there. Enable it for a backend that serves a batch in one request.
+LLM_BATCHING = os.getenv("LLM_BATCHING", "false").lower() == "true"
+LLM_BATCH_MAX_SIZE = int(os.getenv("LLM_BATCH_MAX_SIZE", "16"))
+LLM_BATCH_MAX_WAIT = float(os.getenv("LLM_BATCH_MAX_WAIT", "0.02"))
+# Query embeddings are batched the same way; the embeddings endpoint takes many inputs per request.
+# The wait only applies while another batch is in flight, so a quiet service adds no latency.
+EMBEDDING_BATCH_MAX_SIZE = int(os.getenv("EMBEDDING_BATCH_MAX_SIZE", "64"))
+EMBEDDING_BATCH_MAX_WAIT = float(os.getenv("EMBEDDING_BATCH_MAX_WAIT", "0.01"))
+
+
+# Input validation applied before any retrieval or LLM work
+MAX_QUESTION_CHARS = int(os.getenv("MAX_QUESTION_CHARS", "4096"))
+# Optional rate-limit hook: called with the client ID (e.g. its IP address), returns False to reject
+# the question. Not keyed by conversation ID, since a client gets a fresh one by omitting it.
+rate_limiter: Optional[Callable[[str], bool]] = None
+
+
+# Greeting-only messages are answered from the prompt's greeting rules without any retrieval
+GREETING_ONLY_RE = re.compile(
+    r'^\s*(hi|hello|hey|hiya|ol[aá]|oi|bom dia|boa tarde|boa noite|good (morning|afternoon|evening))[\s!.,]*$',
+    re.IGNORECASE
+)
+
+
+
+
+# Set up structured JSON logging, rendered with orjson
+# Per-request records are logged at DEBUG; set LOG_LEVEL=WARNING in production
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_LEVEL_NO = logging.getLevelName(LOG_LEVEL)
+LOG_VALUE_MAX_CHARS = 500
+
+
+def truncate_log_values(_, __, event_dict: Dict[str, Any]) -> Dict[str, Any]:
+    """Cap long string values (prompts, context, answers); only runs for records that are emitted"""
+    for key, value in event_dict.items():
+        if isinstance(value, str) and len(value) > LOG_VALUE_MAX_CHARS:
+            event_dict[key] = value[:LOG_VALUE_MAX_CHARS] + "..."
+    return event_dict
+
+
+structlog.configure(
+    processors=[
+        structlog.processors.add_log_level,
+        structlog.processors.TimeStamper(fmt="iso"),
+        truncate_log_values,
+        structlog.processors.JSONRenderer(serializer=orjson.dumps),
+    ],
+    wrapper_class=structlog.make_filtering_bound_logger(LOG_LEVEL_NO),
+    logger_factory=structlog.BytesLoggerFactory(),
+    cache_logger_on_first_use=True,
+)
+logger = structlog.get_logger(__name__)
 logger.info("App started!")
 
 
@@ -43,36 +135,139 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
 
 
+@functools.lru_cache(maxsize=1)
+def _build_llm() -> ChatOpenAI:
+    """Build the process-wide LLM client so its HTTP connection pool is reused"""
+    return ChatOpenAI(model="gpt-4o", temperature=0.2, api_key=OPENAI_API_KEY)
+
+
 def get_llm(query_id: str = None, conversation_id: str = None) -> ChatOpenAI:
     """Get a shared LLM instance"""
-    logger.debug("Attempting to initialize LLM", extra={"query_id": query_id or "N/A", "conversation_id": conversation_id or "N/A"})
+    logger.debug("Attempting to initialize LLM", query_id=query_id or "N/A", conversation_id=conversation_id or "N/A")
     if not OPENAI_API_KEY:
-        logger.error("API key for OpenAI is not configured", extra={"query_id": query_id or "N/A", "conversation_id": conversation_id or "N/A"})
+        logger.error("API key for OpenAI is not configured", query_id=query_id or "N/A", conversation_id=conversation_id or "N/A")
         raise ValueError("API key for OpenAI is not configured")
     try:
-        llm = ChatOpenAI(model="gpt-4o", temperature=0.2, api_key=OPENAI_API_KEY)
-        logger.info("LLM initialized successfully", extra={"query_id": query_id or "N/A", "conversation_id": conversation_id or "N/A"})
+        llm = _build_llm()
+        logger.debug("LLM ready", query_id=query_id or "N/A", conversation_id=conversation_id or "N/A")
         return llm
     except Exception as e:
-        logger.error(f"Failed to initialize LLM: {str(e)}", extra={"query_id": query_id or "N/A", "conversation_id": conversation_id or "N/A"})
+        logger.error("Failed to initialize LLM", error=str(e), query_id=query_id or "N/A", conversation_id=conversation_id or "N/A")
         raise
 
 
 
 
 
-def strip_artifacts(output: str, query_id: str, conversation_id: str = None) -> str:
-    """Post-process to remove agent artifacts and invalid placeholders"""
-    logger.debug(f"Original output before stripping: {output[:500]}...", extra={"query_id": query_id, "conversation_id": conversation_id or "N/A"})
+def log_prompt_cache_usage(message: Any, query_id: str, conversation_id: str = None) -> None:
+    """Log how many prompt tokens were served from the provider's prefix cache"""
+    usage = getattr(message, "usage_metadata", None) or {}
+    cached = usage.get("input_token_details", {}).get("cache_read", 0)
+    logger.debug("Prompt token usage", input_tokens=usage.get('input_tokens', 0), cached_tokens=cached, query_id=query_id, conversation_id=conversation_id or "N/A")
+
+
+
+
+async def dispatch_llm_batch(requests: List[Tuple[Any, str, Optional[str]]]) -> List[Any]:
+    """Run (rendered prompt, query ID, conversation ID) requests through the shared LLM, returning parsed text or exceptions"""
+    results = await get_llm().abatch([prompt for prompt, _, _ in requests], return_exceptions=True)
+    outputs = []
+    for (_, query_id, conversation_id), result in zip(requests, results):
+        if isinstance(result, Exception):
+            outputs.append(result)
+        else:
+            log_prompt_cache_usage(result, query_id, conversation_id)
+            outputs.append(StrOutputParser().invoke(result))
+    return outputs
+
+
+async def dispatch_embedding_batch(texts: List[str]) -> List[List[float]]:
+    """Embed many queries with a single embeddings request, using the retriever's embedder"""
+    retriever = get_shared_retriever()
+    if retriever is None:
+        raise RuntimeError("Retriever initialization failed")
+    return await retriever.vectorstore.embeddings.aembed_documents(texts)
+
+
+_llm_batcher = MicroBatcher("LLM", dispatch_llm_batch, LLM_BATCH_MAX_SIZE, LLM_BATCH_MAX_WAIT)
+_embedding_batcher = MicroBatcher("embedding", dispatch_embedding_batch, EMBEDDING_BATCH_MAX_SIZE, EMBEDDING_BATCH_MAX_WAIT)
+
+
+
+
+
+def get_shared_retriever():
+    """Get the process-wide retriever, building it on first use"""
+    global _retriever
+    if _retriever is None:
+        _retriever = get_retriever()
+    return _retriever
+
+
+def reset_retriever() -> None:
+    """Drop the shared retriever so the next query rebuilds it (e.g. after the index is recreated)"""
+    global _retriever
+    _retriever = None
+    clear_retrieval_cache()
+
+
+def clear_retrieval_cache() -> None:
+    """Forget cached retrieval results (call whenever the indexed content changes)"""
+    global _corpus_generation
+    with _retrieval_cache_lock:
+        _corpus_generation += 1
+        _retrieval_cache.clear()
+
+
+
+
+
+@functools.lru_cache(maxsize=1)
+def get_token_encoding() -> Optional[tiktoken.Encoding]:
+    """Get the tokenizer used by the chat model, or None if it can't be loaded (the failure is cached too)"""
     try:
-        output = re.sub(r'^Final Answer:\s*', '', output, flags=re.IGNORECASE).strip()
-        output = re.sub(r'\n\s*Final Answer:\s*', '\n', output, flags=re.IGNORECASE).strip()
-        output = re.sub(r'\[email protected\]', 'the correct email address', output, flags=re.IGNORECASE).strip()
-        logger.debug(f"Stripped output: {output[:500]}...", extra={"query_id": query_id, "conversation_id": conversation_id or "N/A"})
-        return output
+        return tiktoken.encoding_for_model("gpt-4o")
     except Exception as e:
-        logger.error(f"Error stripping artifacts: {str(e)}", extra={"query_id": query_id, "conversation_id": conversation_id or "N/A"})
-        return output
+        logger.warning("Tokenizer unavailable; token counts disabled", error=str(e), query_id="N/A", conversation_id="N/A")
+        return None
+
+
+class TokenCountingWindowMemory(ConversationBufferWindowMemory):
+    """Window memory that keeps only the last k exchanges and counts tokens on demand.
+
+    Nothing is tokenized when saving; total_tokens() tokenizes each message the first time it
+    is asked for and caches the count per message (keyed by identity) until it is evicted.
+    """
+
+    _token_counts: Dict[int, int] = PrivateAttr(default_factory=dict)
+
+    def save_context(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> None:
+        super().save_context(inputs, outputs)
+
+        # The base class keeps every message and only windows on load; drop the rest here
+        messages = self.chat_memory.messages
+        excess = len(messages) - 2 * self.k
+        if excess > 0:
+            for message in messages[:excess]:
+                self._token_counts.pop(id(message), None)
+            del messages[:excess]
+
+    def clear(self) -> None:
+        super().clear()
+        self._token_counts.clear()
+
+    def total_tokens(self) -> Optional[int]:
+        """Number of tokens in the messages currently held, or None without a tokenizer"""
+        encoding = get_token_encoding()
+        if encoding is None:
+            return None
+        total = 0
+        for message in self.chat_memory.messages:
+            count = self._token_counts.get(id(message))
+            if count is None:
+                count = self._token_counts[id(message)] = len(encoding.encode(message.content))
+            total += count
+        return total
 
 
 
@@ -82,140 +277,368 @@ def format_chat_history(memory: ConversationBufferWindowMemory, query_id: str, c
     try:
         history = memory.load_memory_variables({})
         chat_history = history.get("chat_history", "")
-        logger.debug(f"Raw chat history from memory: {chat_history or 'Empty'}", extra={"query_id": query_id, "conversation_id": conversation_id})
+        logger.debug("Raw chat history from memory", chat_history=chat_history or 'Empty', query_id=query_id, conversation_id=conversation_id)
         
         if not chat_history:
-            logger.debug("No chat history available in memory", extra={"query_id": query_id, "conversation_id": conversation_id})
+            logger.debug("No chat history available in memory", query_id=query_id, conversation_id=conversation_id)
             return "No previous conversation history."
 
-        # Since return_messages=False, chat_history is a string; format it clearly
-        formatted_history = f"Conversation History:\n{chat_history.replace('Human: ', 'User: ').replace('Assistant: ', 'AI: ')}"
-        logger.debug(f"Formatted chat history: {formatted_history[:500]}...", extra={"query_id": query_id, "conversation_id": conversation_id})
+        # Since return_messages=False, chat_history is a string already prefixed with "User:"/"AI:"
+        formatted_history = f"Conversation History:\n{chat_history}"
+        logger.debug("Formatted chat history", chat_history=formatted_history, query_id=query_id, conversation_id=conversation_id)
         return formatted_history
     except Exception as e:
-        logger.error(f"Error formatting chat history: {str(e)}", extra={"query_id": query_id, "conversation_id": conversation_id})
+        logger.error("Error formatting chat history", error=str(e), query_id=query_id, conversation_id=conversation_id)
         return "Error accessing chat history."
 
 
 
 
+def needs_retrieval(input_str: str) -> bool:
+    """Decide whether the query needs knowledge base context (greetings do not)"""
+    return GREETING_ONLY_RE.match(input_str) is None
+
+
 
-def handle_query(input_str: str, query_id: str, memory: ConversationBufferWindowMemory, conversation_id: str = None) -> str:
-    """Handle all queries (greetings, RAG, etc.) using the unified chain with memory"""
-    logger.info(f"Processing query: {input_str}", extra={"query_id": query_id, "conversation_id": conversation_id or "N/A"})
+
+def get_doc_ids(docs: List[Document]) -> FrozenSet[str]:
+    """Identify retrieved documents by vector id, falling back to their content"""
+    return frozenset(doc.id or doc.page_content for doc in docs)
+
+
+
+
+async def embed_and_retrieve(input_str: str, query_id: str, conversation_id: str = None) -> Tuple[Optional[np.ndarray], Optional[List[Document]]]:
+    """Embed the query once and reuse the embedding for the vector search; exact repeats hit the cache"""
+    cache_key = input_str.strip().lower()
+    with _retrieval_cache_lock:
+        cached = _retrieval_cache.get(cache_key)
+        generation = _corpus_generation
+    if cached is not None:
+        logger.debug("Retrieval cache hit", query_id=query_id, conversation_id=conversation_id or "N/A")
+        return cached
+
+    retriever = get_shared_retriever()
+    if retriever is None:
+        logger.error("Retriever initialization failed", query_id=query_id, conversation_id=conversation_id or "N/A")
+        return None, None
     try:
-        if not input_str.strip():
-            logger.warning("Empty query received", extra={"query_id": query_id, "conversation_id": conversation_id or "N/A"})
-            return "I'm sorry, it seems you didn't provide a question. How can I assist you today?"
-
-        logger.debug("Attempting to initialize retriever", extra={"query_id": query_id, "conversation_id": conversation_id or "N/A"})
-        retriever = get_retriever()
-        if retriever is None:
-            logger.error("Retriever initialization failed", extra={"query_id": query_id, "conversation_id": conversation_id or "N/A"})
-            return "I'm sorry, we're experiencing an issue with our information system. Please try again later or contact support."
-
-        # Retrieve relevant documents
-        logger.debug("Invoking retriever for query", extra={"query_id": query_id, "conversation_id": conversation_id or "N/A"})
-        try:
-            docs = retriever.invoke(input_str)
-        except Exception as e:
-            logger.error(f"Retriever invocation failed: {str(e)}", extra={"query_id": query_id, "conversation_id": conversation_id or "N/A"})
-            return "I'm sorry, I couldn't retrieve the necessary information. Please try rephrasing your question or contact our support team."
+        vector_store = retriever.vectorstore
+        embedding = np.asarray(await _embedding_batcher.submit(input_str), dtype=np.float32)
+        docs = await vector_store.asimilarity_search_by_vector(embedding.tolist(), **retriever.search_kwargs)
+        norm = np.linalg.norm(embedding)
+        result = (embedding / norm if norm else embedding), docs
+        with _retrieval_cache_lock:
+            if generation == _corpus_generation:  # Otherwise the docs may predate a corpus change
+                _retrieval_cache[cache_key] = result
+        return result
+    except Exception as e:
+        logger.error("Embedding or retrieval failed", error=str(e), query_id=query_id, conversation_id=conversation_id or "N/A")
+        return None, None
+
+
+
+
+class SemanticCacheBucket:
+    """Fixed-size ring of cached answers, their normalized query embeddings and retrieved doc ids"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.embeddings: Optional[np.ndarray] = None  # Allocated on first add, once the dimension is known
+        self.answers: List[str] = []
+        self.doc_ids: List[FrozenSet[str]] = []
+        self._next = 0
+
+    def add(self, embedding: np.ndarray, answer: str, doc_ids: FrozenSet[str]) -> None:
+        if self.embeddings is None:
+            self.embeddings = np.empty((self.max_entries, embedding.shape[0]), dtype=np.float32)
+        i = self._next
+        self.embeddings[i] = embedding
+        if i < len(self.answers):
+            self.answers[i], self.doc_ids[i] = answer, doc_ids
+        else:
+            self.answers.append(answer)
+            self.doc_ids.append(doc_ids)
+        self._next = (i + 1) % self.max_entries
+
+    def best_match(self, embedding: np.ndarray) -> Tuple[float, str, FrozenSet[str]]:
+        """Most similar cached entry as (cosine similarity, answer, doc ids)"""
+        sims = self.embeddings[:len(self.answers)] @ embedding
+        best = int(np.argmax(sims))
+        return float(sims[best]), self.answers[best], self.doc_ids[best]
+
+
+
+
+def lookup_cached_answer(domain_instructions: str, embedding: np.ndarray, doc_ids: FrozenSet[str], query_id: str, conversation_id: str) -> Optional[str]:
+    """Return a cached answer for a near-duplicate opening question that is still grounded in the same documents"""
+    with _answer_cache_lock:
+        bucket = _answer_cache.get(domain_instructions)
+        if bucket is None:
+            return None
+        similarity, answer, cached_ids = bucket.best_match(embedding)
+    if similarity < SEMANTIC_CACHE_THRESHOLD:
+        return None
+    union = cached_ids | doc_ids
+    overlap = len(cached_ids & doc_ids) / len(union) if union else 1.0
+    if overlap < GROUNDING_THRESHOLD:
+        logger.debug("Semantic cache match rejected by grounding check", overlap=overlap, query_id=query_id, conversation_id=conversation_id)
+        return None
+    logger.debug("Semantic cache hit", similarity=similarity, query_id=query_id, conversation_id=conversation_id)
+    return answer
+
+
 
-        context = "\n\n".join(doc.page_content for doc in docs if doc.page_content) if docs else ""
-        logger.info(f"Retrieved RAG context (first 500 chars): {context[:500]}...", extra={"query_id": query_id, "conversation_id": conversation_id or "N/A"})
 
-        # Load and format chat history
-        chat_history = format_chat_history(memory, query_id, conversation_id)
-        logger.info(f"Using chat history for response: {chat_history[:500]}...", extra={"query_id": query_id, "conversation_id": conversation_id or "N/A"})
+def store_cached_answer(domain_instructions: str, embedding: np.ndarray, answer: str, doc_ids: FrozenSet[str]) -> None:
+    """Remember an answer to an opening question for reuse on near-duplicates"""
+    with _answer_cache_lock:
+        bucket = _answer_cache.get(domain_instructions)
+        if bucket is None:
+            bucket = _answer_cache[domain_instructions] = SemanticCacheBucket(SEMANTIC_CACHE_MAX_ENTRIES)
+        bucket.add(embedding, answer, doc_ids)
 
-        # Initialize LLM and chain
+
+
+
+
+class StreamInterruptedError(RuntimeError):
+    """The LLM failed after part of a streamed answer was already sent"""
+
+
+
+
+async def stream_query(input_str: str, query_id: str, memory: TokenCountingWindowMemory, conversation_id: str = None,
+                       docs: Optional[List[Document]] = None, query_embedding: Optional[np.ndarray] = None,
+                       stream: bool = False) -> AsyncIterator[str]:
+    """Handle all queries (greetings, RAG, etc.) using the unified chain with memory, yielding the answer text.
+
+    When query_embedding is given, the answer is stored in the semantic cache for opening questions.
+    """
+    logger.debug("Processing query", question=input_str, query_id=query_id, conversation_id=conversation_id or "N/A")
+    try:
+        parts = [doc.page_content for doc in docs if doc.page_content] if docs else []
+        context = "\n\n".join(parts) if parts else ""
+        logger.debug("Retrieved RAG context", context=context, query_id=query_id, conversation_id=conversation_id or "N/A")
+
+        # Render the prompt and run it through the LLM (streamed, or batched with concurrent queries)
+        streamed = False  # Whether part of the answer was already sent; an error then can't be replaced by a reply
         try:
-            chain = rag_prompt | get_llm(query_id, conversation_id) | StrOutputParser()
-            logger.debug("Invoking chain with inputs", extra={"query_id": query_id, "conversation_id": conversation_id or "N/A"})
-            output = chain.invoke({
-                "domain_instructions": DOMAIN_INSTRUCTIONS,
+            # Load and format chat history
+            chat_history = format_chat_history(memory, query_id, conversation_id)
+            if LOG_LEVEL_NO <= logging.DEBUG:
+                logger.debug("Using chat history for response", history_tokens=memory.total_tokens(), chat_history=chat_history, query_id=query_id, conversation_id=conversation_id or "N/A")
+            domain_instructions = DOMAIN_INSTRUCTIONS
+            prompt = await rag_prompt.ainvoke({
+                "domain_instructions": domain_instructions,
                 "context": context,
                 "chat_history": chat_history,
                 "question": input_str
             })
-            logger.debug(f"Raw LLM output: {output[:500]}...", extra={"query_id": query_id, "conversation_id": conversation_id or "N/A"})
+            if stream:
+                # Stream tokens straight through, stripping artifacts incrementally; token usage
+                # arrives on the last chunk
+                logger.debug("Streaming LLM output", query_id=query_id, conversation_id=conversation_id or "N/A")
+                stream_filter = ArtifactStreamFilter()
+                chunks = []
+                usage_chunk = None
+                async for message_chunk in get_llm(query_id, conversation_id).astream(prompt, stream_usage=True):
+                    if message_chunk.usage_metadata:
+                        usage_chunk = message_chunk
+                    chunk = message_chunk.content
+                    if not chunk:
+                        continue
+                    chunks.append(chunk)
+                    text = stream_filter.feed(chunk)
+                    if text:
+                        streamed = True
+                        yield text
+                text = stream_filter.flush()
+                if text:
+                    streamed = True
+                    yield text
+                output = "".join(chunks)
+                log_prompt_cache_usage(usage_chunk, query_id, conversation_id)
+            elif LLM_BATCHING:
+                logger.debug("Submitting prompt to LLM batcher", query_id=query_id, conversation_id=conversation_id or "N/A")
+                output = await _llm_batcher.submit((prompt, query_id, conversation_id))
+            else:
+                message = await get_llm(query_id, conversation_id).ainvoke(prompt)
+                log_prompt_cache_usage(message, query_id, conversation_id)
+                output = StrOutputParser().invoke(message)
+            logger.debug("Raw LLM output", output=output, query_id=query_id, conversation_id=conversation_id or "N/A")
         except LangChainException as le:
-            logger.error(f"LLM chain invocation failed: {str(le)}", extra={"query_id": query_id, "conversation_id": conversation_id or "N/A"})
-            return "I'm sorry, there was an issue processing your request. Please try again or contact support for assistance."
+            logger.error("LLM chain invocation failed", error=str(le), query_id=query_id, conversation_id=conversation_id or "N/A")
+            if streamed:
+                raise StreamInterruptedError("LLM stream failed mid-answer") from le
+            yield "I'm sorry, there was an issue processing your request. Please try again or contact support for assistance."
+            return
         except Exception as e:
-            logger.error(f"Unexpected error during chain invocation: {str(e)}", extra={"query_id": query_id, "conversation_id": conversation_id or "N/A"})
-            return "An unexpected error occurred. Please try again later or reach out to our support team."
+            logger.error("Unexpected error during chain invocation", error=str(e), query_id=query_id, conversation_id=conversation_id or "N/A")
+            if streamed:
+                raise StreamInterruptedError("LLM stream failed mid-answer") from e
+            yield "An unexpected error occurred. Please try again later or reach out to our support team."
+            return
 
         # Strip artifacts
         output = strip_artifacts(output, query_id, conversation_id)
 
+        # Cache the answer for near-duplicate opening questions
+        if query_embedding is not None:
+            store_cached_answer(domain_instructions, query_embedding, output, get_doc_ids(docs))
+
         # Save to memory
         try:
             memory.save_context({"question": input_str}, {"output": output})
-            logger.debug(f"Saved to memory: Question: {input_str}, Answer: {output[:500]}...", extra={"query_id": query_id, "conversation_id": conversation_id or "N/A"})
-            # Log the updated memory content
-            updated_history = format_chat_history(memory, query_id, conversation_id)
-            logger.info(f"Updated memory context after saving: {updated_history[:500]}...", extra={"query_id": query_id, "conversation_id": conversation_id or "N/A"})
+            logger.debug("Saved to memory", question=input_str, output=output, query_id=query_id, conversation_id=conversation_id or "N/A")
         except Exception as e:
-            logger.error(f"Failed to save to memory: {str(e)}", extra={"query_id": query_id, "conversation_id": conversation_id or "N/A"})
-            logger.warning("Proceeding despite memory save failure", extra={"query_id": query_id, "conversation_id": conversation_id or "N/A"})
+            logger.error("Failed to save to memory", error=str(e), query_id=query_id, conversation_id=conversation_id or "N/A")
+            logger.warning("Proceeding despite memory save failure", query_id=query_id, conversation_id=conversation_id or "N/A")
 
-        logger.info(f"Generated response: {output[:500]}...", extra={"query_id": query_id, "conversation_id": conversation_id or "N/A"})
-        return output
+        logger.debug("Generated response", output=output, query_id=query_id, conversation_id=conversation_id or "N/A")
+        if not stream:
+            yield output
 
+    except StreamInterruptedError:
+        raise
     except Exception as e:
-        logger.critical(f"Critical error in handle_query: {str(e)}", extra={"query_id": query_id, "conversation_id": conversation_id or "N/A"})
-        return "We're sorry, an unexpected error occurred. Please try again later or contact our support team for assistance."
+        logger.critical("Critical error in stream_query", error=str(e), query_id=query_id, conversation_id=conversation_id or "N/A")
+        yield "We're sorry, an unexpected error occurred. Please try again later or contact our support team for assistance."
+
+
 
 
 
 
+def new_query_id() -> str:
+    """Short random ID used to correlate log records of one request"""
+    return secrets.token_hex(8)
 
 
-def answer_question(user_question: str, conversation_id: Optional[str] = None) -> Dict[str, str]:
-    """Answer user question using the unified handler with memory"""
-    query_id = str(uuid.uuid4())
-    conversation_id = conversation_id or str(uuid.uuid4())
-    logger.info(f"Received question: {user_question}", extra={"query_id": query_id, "conversation_id": conversation_id})
+def new_conversation_id() -> str:
+    """Random conversation ID; 128 bits since it is the only key to a conversation's memory"""
+    return secrets.token_hex(16)
+
+
+
+
+class QuestionRejectedError(ValueError):
+    """A question was rejected before any retrieval or LLM work; kind is "invalid" or "rate_limited" """
+
+    def __init__(self, kind: str, message: str):
+        super().__init__(message)
+        self.kind = kind
+
+
+
+
+def validate_question(user_question: Any, query_id: str, conversation_id: str, client_id: Optional[str] = None) -> None:
+    """Reject invalid or rate-limited questions up front by raising QuestionRejectedError"""
+    if not isinstance(user_question, str):
+        logger.warning("Non-text question received", query_id=query_id, conversation_id=conversation_id)
+        raise QuestionRejectedError("invalid", "Only text questions are supported. Please ask your question as text.")
+    if not user_question.strip():
+        logger.warning("Empty question received", query_id=query_id, conversation_id=conversation_id)
+        raise QuestionRejectedError("invalid", "No question provided. Please ask a question to proceed.")
+    if len(user_question) > MAX_QUESTION_CHARS:
+        logger.warning("Question too long", length=len(user_question), query_id=query_id, conversation_id=conversation_id)
+        raise QuestionRejectedError("invalid", f"Your question is too long. Please keep it to {MAX_QUESTION_CHARS} characters or fewer.")
+    if rate_limiter is not None and not rate_limiter(client_id or "unknown"):
+        logger.warning("Question rejected by rate limiter", client_id=client_id, query_id=query_id, conversation_id=conversation_id)
+        raise QuestionRejectedError("rate_limited", "You're sending questions too quickly. Please wait a moment and try again.")
+
+
+
+
+
+
+async def generate_answer(user_question: str, query_id: str, conversation_id: str, stream: bool = False) -> AsyncIterator[str]:
+    """Answer user question using the unified handler with memory, yielding the answer text"""
+    logger.debug("Received question", question=user_question, query_id=query_id, conversation_id=conversation_id)
     
     try:
-        if not user_question.strip():
-            logger.warning("Empty question received", extra={"query_id": query_id, "conversation_id": conversation_id})
-            return {
-                "answer": "It looks like you didn't ask a question. How can I help you today?",
-                "conversation_id": conversation_id
-            }
-
-        # Initialize memory if not exists
-        if conversation_id not in memories:
-            logger.debug(f"Creating new memory for conversation ID: {conversation_id}", extra={"query_id": query_id, "conversation_id": conversation_id})
-            try:
-                memories[conversation_id] = ConversationBufferWindowMemory(
-                    k=5,  # Keep last 5 exchanges
-                    memory_key="chat_history",
-                    input_key="question",
-                    return_messages=False  # Return as string
-                )
-                logger.info(f"Memory initialized for conversation ID: {conversation_id}", extra={"query_id": query_id, "conversation_id": conversation_id})
-            except Exception as e:
-                logger.error(f"Failed to initialize memory: {str(e)}", extra={"query_id": query_id, "conversation_id": conversation_id})
-                return {
-                    "answer": "I'm sorry, there was an issue setting up the conversation. Please try again.",
-                    "conversation_id": conversation_id
-                }
-
-        memory = memories[conversation_id]
-        output = handle_query(user_question, query_id, memory, conversation_id)
-        logger.info(f"Final answer: {output[:500]}...", extra={"query_id": query_id, "conversation_id": conversation_id})
-        return {
-            "answer": output,
-            "conversation_id": conversation_id
-        }
-
+        # Initialize memory if not exists; re-inserting refreshes its expiry
+        with _conversations_lock:
+            memory = memories.get(conversation_id)
+            if memory is None:
+                logger.debug("Creating new memory for conversation", query_id=query_id, conversation_id=conversation_id)
+                try:
+                    memory = TokenCountingWindowMemory(
+                        k=5,  # Keep last 5 exchanges
+                        memory_key="chat_history",
+                        input_key="question",
+                        human_prefix="User",
+                        ai_prefix="AI",
+                        return_messages=False  # Return as string
+                    )
+                    logger.debug("Memory initialized for conversation", query_id=query_id, conversation_id=conversation_id)
+                except Exception as e:
+                    logger.error("Failed to initialize memory", error=str(e), query_id=query_id, conversation_id=conversation_id)
+                    memory = None
+            if memory is not None:
+                memories[conversation_id] = memory
+        if memory is None:
+            yield "I'm sorry, there was an issue setting up the conversation. Please try again."
+            return
+
+        # Greetings skip retrieval entirely; the prompt handles them with empty context
+        if not needs_retrieval(user_question):
+            logger.debug("Greeting-only query, skipping retrieval", query_id=query_id, conversation_id=conversation_id)
+            embedding, docs = None, []
+        else:
+            embedding, docs = await embed_and_retrieve(user_question, query_id, conversation_id)
+            if docs is None:  # embed_and_retrieve already logged the failure
+                yield "I'm sorry, I couldn't retrieve the necessary information. Please try rephrasing your question or contact our support team."
+                return
+
+        # Serve near-duplicate opening questions from the shared semantic cache, skipping the LLM;
+        # once there is chat history the answer depends on it, so later turns are neither served nor cached
+        opening_question = embedding is not None and not memory.chat_memory.messages
+        if opening_question:
+            cached = lookup_cached_answer(DOMAIN_INSTRUCTIONS, embedding, get_doc_ids(docs), query_id, conversation_id)
+            if cached is not None:
+                try:
+                    memory.save_context({"question": user_question}, {"output": cached})
+                except Exception as e:
+                    logger.error("Failed to save cached answer to memory", error=str(e), query_id=query_id, conversation_id=conversation_id)
+                yield cached
+                return
+
+        async for chunk in stream_query(user_question, query_id, memory, conversation_id, docs=docs,
+                                        query_embedding=embedding if opening_question else None, stream=stream):
+            yield chunk
+
+    except StreamInterruptedError:
+        raise
     except Exception as e:
-        logger.critical(f"Critical error in answer_question: {str(e)}", extra={"query_id": query_id, "conversation_id": conversation_id})
-        return {
-            "answer": "We're sorry, an unexpected error occurred. Please try again or contact support.",
-            "conversation_id": conversation_id
-        }
\ No newline at end of file
+        logger.critical("Critical error in generate_answer", error=str(e), query_id=query_id, conversation_id=conversation_id)
+        yield "We're sorry, an unexpected error occurred. Please try again or contact support."
+
+
+
+
+
+
+async def answer_question(user_question: str, conversation_id: Optional[str] = None, client_id: Optional[str] = None) -> Dict[str, str]:
+    """Answer user question using the unified handler with memory; raises QuestionRejectedError for rejected questions"""
+    query_id = new_query_id()
+    conversation_id = conversation_id or new_conversation_id()
+    validate_question(user_question, query_id, conversation_id, client_id)
+
+    output = "".join([chunk async for chunk in generate_answer(user_question, query_id, conversation_id)])
+    logger.debug("Final answer", output=output, query_id=query_id, conversation_id=conversation_id)
+    return {
+        "answer": output,
+        "conversation_id": conversation_id
+    }
+
+
+
+
+async def stream_answer(user_question: str, conversation_id: str, client_id: Optional[str] = None) -> AsyncIterator[str]:
+    """Answer user question token by token for streaming responses; raises QuestionRejectedError for rejected questions"""
+    query_id = new_query_id()
+    validate_question(user_question, query_id, conversation_id, client_id)
+
+    async for chunk in generate_answer(user_question, query_id, conversation_id, stream=True):
+        yield chunk
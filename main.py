@@ -1,38 +1,48 @@
 import os
+import json
 import shutil
-import uuid
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, UploadFile, File, Form, Request
-from fastapi.responses import JSONResponse, HTMLResponse
+from fastapi.responses import JSONResponse, HTMLResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 from typing import List, Optional
 from pydantic import BaseModel, ValidationError
 from new_content import process_and_save_pdfs, process_and_save_urls, delete_and_recreate_index, clear_pinecone_index
-from cx_support_agent import answer_question, DOMAIN_INSTRUCTIONS
+import cx_support_agent
+from cx_support_agent import answer_question, stream_answer, QuestionRejectedError, new_query_id, new_conversation_id, get_shared_retriever, reset_retriever, clear_retrieval_cache, LOG_LEVEL_NO
 import logging
+import structlog
 
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
 
-# Set up logging with detailed format
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+# Structured logging is configured in cx_support_agent
+logger = structlog.get_logger(__name__)
 logger.info("App started!")
 
 
 # Load environment variables
 try:
     load_dotenv()
-    logger.debug("Environment variables loaded successfully", extra={"query_id": "N/A", "conversation_id": "N/A"})
+    logger.debug("Environment variables loaded successfully", query_id="N/A", conversation_id="N/A")
 except Exception as e:
-    logger.error(f"Failed to load environment variables: {str(e)}", extra={"query_id": "N/A", "conversation_id": "N/A"})
+    logger.error("Failed to load environment variables", error=str(e), query_id="N/A", conversation_id="N/A")
 
 
 
 
 
-app = FastAPI(title="Modular Customer Support Agent")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Warm the shared retriever so the first user request doesn't pay init latency
+    if get_shared_retriever() is None:
+        logger.warning("Retriever warm-up failed; it will be retried on the first query", query_id="N/A", conversation_id="N/A")
+    yield
+
+
+app = FastAPI(title="Modular Customer Support Agent", lifespan=lifespan)
 
 # Enable CORS
 app.add_middleware(
@@ -51,22 +61,22 @@ class ConfigRequest(BaseModel):
 
 @app.post("/set_config")
 async def set_config(req: ConfigRequest):
-    query_id = str(uuid.uuid4())
-    logger.info(f"Received config request: {req.domain_instructions[:100]}...", extra={"query_id": query_id, "conversation_id": "N/A"})
+    query_id = new_query_id()
+    logger.info("Received config request", domain_instructions=req.domain_instructions, query_id=query_id, conversation_id="N/A")
     try:
         if not req.domain_instructions.strip():
-            logger.warning("Empty domain instructions provided", extra={"query_id": query_id, "conversation_id": "N/A"})
+            logger.warning("Empty domain instructions provided", query_id=query_id, conversation_id="N/A")
             return JSONResponse(
                 {"error": "Domain instructions cannot be empty. Please provide valid instructions."},
                 status_code=400
             )
         
-        global DOMAIN_INSTRUCTIONS
-        DOMAIN_INSTRUCTIONS = req.domain_instructions
-        logger.info(f"Set domain instructions: {DOMAIN_INSTRUCTIONS[:100]}...", extra={"query_id": query_id, "conversation_id": "N/A"})
+        # Set it on the agent module, which reads it when rendering the prompt
+        cx_support_agent.DOMAIN_INSTRUCTIONS = req.domain_instructions
+        logger.info("Set domain instructions", domain_instructions=cx_support_agent.DOMAIN_INSTRUCTIONS, query_id=query_id, conversation_id="N/A")
         return JSONResponse({"message": "Configuration applied successfully! The agent is now adapted to your settings."})
     except Exception as e:
-        logger.error(f"Error setting config: {str(e)}", extra={"query_id": query_id, "conversation_id": "N/A"})
+        logger.error("Error setting config", error=str(e), query_id=query_id, conversation_id="N/A")
         return JSONResponse(
             {"error": "Failed to apply configuration. Please try again or contact support."},
             status_code=500
@@ -77,18 +87,18 @@ async def set_config(req: ConfigRequest):
 
 @app.get("/", response_class=HTMLResponse)
 async def index():
-    query_id = str(uuid.uuid4())
-    logger.info("Serving index page", extra={"query_id": query_id, "conversation_id": "N/A"})
+    query_id = new_query_id()
+    logger.info("Serving index page", query_id=query_id, conversation_id="N/A")
     try:
         return """
         <h2>PDF and URL Question Answering API</h2>
         <p>Use <b>/upload_pdf</b> to upload PDFs and <b>/upload_url</b> to upload URLs (comma-separated).</p>
-        <p>Use <b>/ask</b> to query the index.</p>
+        <p>Use <b>/ask</b> to query the index, or <b>/ask_stream</b> to receive the answer as server-sent events.</p>
         <p>For either upload endpoint, use clear_index=true with no content to delete and recreate the index.</p>
         <p>Use <b>/clear_index</b> to clear the vector index.</p>
         """
     except Exception as e:
-        logger.error(f"Error serving index page: {str(e)}", extra={"query_id": query_id, "conversation_id": "N/A"})
+        logger.error("Error serving index page", error=str(e), query_id=query_id, conversation_id="N/A")
         return HTMLResponse(
             content="Error: Unable to load the index page. Please try again later.",
             status_code=500
@@ -102,50 +112,52 @@ async def upload_pdf(
     pdf_files: List[UploadFile] = File([]),
     clear_index: bool = Form(False)
 ):
-    query_id = str(uuid.uuid4())
-    logger.info(f"Received PDF upload request, clear_index={clear_index}", extra={"query_id": query_id, "conversation_id": "N/A"})
+    query_id = new_query_id()
+    logger.info("Received PDF upload request", clear_index=clear_index, query_id=query_id, conversation_id="N/A")
     file_paths = []
     try:
         if clear_index and len(pdf_files) == 0:
-            logger.debug("Attempting to delete and recreate Pinecone index", extra={"query_id": query_id, "conversation_id": "N/A"})
+            logger.debug("Attempting to delete and recreate Pinecone index", query_id=query_id, conversation_id="N/A")
             try:
                 delete_and_recreate_index()
-                logger.info("Index deleted and recreated successfully", extra={"query_id": query_id, "conversation_id": "N/A"})
+                reset_retriever()
+                logger.info("Index deleted and recreated successfully", query_id=query_id, conversation_id="N/A")
                 return JSONResponse({"message": "Index deleted and recreated successfully!"})
             except Exception as e:
-                logger.error(f"Failed to delete and recreate index: {str(e)}", extra={"query_id": query_id, "conversation_id": "N/A"})
+                logger.error("Failed to delete and recreate index", error=str(e), query_id=query_id, conversation_id="N/A")
                 return JSONResponse(
                     {"error": "Failed to reset the index. Please try again or contact support."},
                     status_code=500
                 )
 
         if len(pdf_files) == 0:
-            logger.warning("No PDFs provided", extra={"query_id": query_id, "conversation_id": "N/A"})
+            logger.warning("No PDFs provided", query_id=query_id, conversation_id="N/A")
             return JSONResponse(
                 {"error": "No PDFs provided. Please upload at least one PDF file."},
                 status_code=400
             )
 
         file_names = [pdf.filename for pdf in pdf_files]
-        logger.info(f"Processing PDFs: {file_names}", extra={"query_id": query_id, "conversation_id": "N/A"})
+        logger.info("Processing PDFs", file_names=file_names, query_id=query_id, conversation_id="N/A")
 
         for pdf in pdf_files:
-            logger.debug(f"Saving PDF file: {pdf.filename}", extra={"query_id": query_id, "conversation_id": "N/A"})
+            logger.debug("Saving PDF file", filename=pdf.filename, query_id=query_id, conversation_id="N/A")
             temp_path = f"temp_{pdf.filename}"
             try:
                 with open(temp_path, "wb") as buffer:
                     shutil.copyfileobj(pdf.file, buffer)
                 file_paths.append(temp_path)
             except Exception as e:
-                logger.error(f"Failed to save PDF {pdf.filename}: {str(e)}", extra={"query_id": query_id, "conversation_id": "N/A"})
+                logger.error("Failed to save PDF", filename=pdf.filename, error=str(e), query_id=query_id, conversation_id="N/A")
                 raise
 
-        logger.debug("Calling process_and_save_pdfs", extra={"query_id": query_id, "conversation_id": "N/A"})
+        logger.debug("Calling process_and_save_pdfs", query_id=query_id, conversation_id="N/A")
         try:
             process_and_save_pdfs(file_paths, clear_index=clear_index)
-            logger.info("PDFs processed successfully", extra={"query_id": query_id, "conversation_id": "N/A"})
+            clear_retrieval_cache()
+            logger.info("PDFs processed successfully", query_id=query_id, conversation_id="N/A")
         except Exception as e:
-            logger.error(f"Failed to process PDFs: {str(e)}", extra={"query_id": query_id, "conversation_id": "N/A"})
+            logger.error("Failed to process PDFs", error=str(e), query_id=query_id, conversation_id="N/A")
             raise
 
         # Cleanup temp files
@@ -153,9 +165,9 @@ async def upload_pdf(
             if os.path.exists(path):
                 try:
                     os.remove(path)
-                    logger.debug(f"Cleaned up temp file: {path}", extra={"query_id": query_id, "conversation_id": "N/A"})
+                    logger.debug("Cleaned up temp file", path=path, query_id=query_id, conversation_id="N/A")
                 except Exception as e:
-                    logger.warning(f"Failed to clean up temp file {path}: {str(e)}", extra={"query_id": query_id, "conversation_id": "N/A"})
+                    logger.warning("Failed to clean up temp file", path=path, error=str(e), query_id=query_id, conversation_id="N/A")
 
         return JSONResponse({"message": "PDFs processed and vectors added to the index successfully!"})
     except Exception as e:
@@ -164,10 +176,10 @@ async def upload_pdf(
             if os.path.exists(path):
                 try:
                     os.remove(path)
-                    logger.debug(f"Cleaned up temp file on error: {path}", extra={"query_id": query_id, "conversation_id": "N/A"})
+                    logger.debug("Cleaned up temp file on error", path=path, query_id=query_id, conversation_id="N/A")
                 except Exception as e_cleanup:
-                    logger.warning(f"Failed to clean up temp file {path} on error: {str(e_cleanup)}", extra={"query_id": query_id, "conversation_id": "N/A"})
-        logger.error(f"Error processing PDFs: {str(e)}", extra={"query_id": query_id, "conversation_id": "N/A"})
+                    logger.warning("Failed to clean up temp file on error", path=path, error=str(e_cleanup), query_id=query_id, conversation_id="N/A")
+        logger.error("Error processing PDFs", error=str(e), query_id=query_id, conversation_id="N/A")
         return JSONResponse(
             {"error": "Failed to process PDFs. Please check your files and try again."},
             status_code=500
@@ -181,37 +193,39 @@ async def upload_url(
     urls: str = Form(""),
     clear_index: bool = Form(False)
 ):
-    query_id = str(uuid.uuid4())
-    logger.info(f"Received URL upload request, urls={urls}, clear_index={clear_index}", extra={"query_id": query_id, "conversation_id": "N/A"})
+    query_id = new_query_id()
+    logger.info("Received URL upload request", urls=urls, clear_index=clear_index, query_id=query_id, conversation_id="N/A")
     try:
         urls_list = [u.strip() for u in urls.split(',') if u.strip()]
 
         if clear_index and not urls_list:
-            logger.debug("Attempting to delete and recreate Pinecone index", extra={"query_id": query_id, "conversation_id": "N/A"})
+            logger.debug("Attempting to delete and recreate Pinecone index", query_id=query_id, conversation_id="N/A")
             try:
                 delete_and_recreate_index()
-                logger.info("Index deleted and recreated successfully", extra={"query_id": query_id, "conversation_id": "N/A"})
+                reset_retriever()
+                logger.info("Index deleted and recreated successfully", query_id=query_id, conversation_id="N/A")
                 return JSONResponse({"message": "Index deleted and recreated successfully!"})
             except Exception as e:
-                logger.error(f"Failed to delete and recreate index: {str(e)}", extra={"query_id": query_id, "conversation_id": "N/A"})
+                logger.error("Failed to delete and recreate index", error=str(e), query_id=query_id, conversation_id="N/A")
                 return JSONResponse(
                     {"error": "Failed to reset the index. Please try again or contact support."},
                     status_code=500
                 )
 
         if not urls_list:
-            logger.warning("No URLs provided", extra={"query_id": query_id, "conversation_id": "N/A"})
+            logger.warning("No URLs provided", query_id=query_id, conversation_id="N/A")
             return JSONResponse(
                 {"error": "No URLs provided. Please provide at least one valid URL."},
                 status_code=400
             )
 
-        logger.debug(f"Processing URLs: {urls_list}", extra={"query_id": query_id, "conversation_id": "N/A"})
+        logger.debug("Processing URLs", urls=urls_list, query_id=query_id, conversation_id="N/A")
         try:
             process_and_save_urls(urls_list, clear_index=clear_index)
-            logger.info("URLs processed successfully", extra={"query_id": query_id, "conversation_id": "N/A"})
+            clear_retrieval_cache()
+            logger.info("URLs processed successfully", query_id=query_id, conversation_id="N/A")
         except Exception as e:
-            logger.error(f"Failed to process URLs: {str(e)}", extra={"query_id": query_id, "conversation_id": "N/A"})
+            logger.error("Failed to process URLs", error=str(e), query_id=query_id, conversation_id="N/A")
             if str(e) == "Website owner does not allow content access":
                 return JSONResponse(
                     {"error": "Website owner does not allow content access. Please check the URLs and try again."},
@@ -221,7 +235,7 @@ async def upload_url(
 
         return JSONResponse({"message": "URLs processed and vectors added to the index successfully!"})
     except Exception as e:
-        logger.error(f"Error processing URLs: {str(e)}", extra={"query_id": query_id, "conversation_id": "N/A"})
+        logger.error("Error processing URLs", error=str(e), query_id=query_id, conversation_id="N/A")
         return JSONResponse(
             {"error": "Failed to process URLs. Please check your URLs and try again."},
             status_code=500
@@ -234,39 +248,44 @@ class QuestionRequest(BaseModel):
     question: str
     conversation_id: Optional[str] = None
 
+
+def client_id(request: Request) -> str:
+    """Identify the caller for rate limiting by its IP address"""
+    return request.client.host if request.client else "unknown"
+
 @app.post("/ask")
 async def ask_question(request: Request, req: QuestionRequest):
-    query_id = str(uuid.uuid4())
-    conversation_id = req.conversation_id or str(uuid.uuid4())
-    logger.info(f"Received raw request body: {await request.json()}", extra={"query_id": query_id, "conversation_id": conversation_id})
-    logger.info(f"Received question: {req.question}", extra={"query_id": query_id, "conversation_id": conversation_id})
+    query_id = new_query_id()
+    conversation_id = req.conversation_id or new_conversation_id()
+    if LOG_LEVEL_NO <= logging.DEBUG:
+        logger.debug("Received raw request body", body=await request.json(), query_id=query_id, conversation_id=conversation_id)
+    logger.debug("Received question", question=req.question, query_id=query_id, conversation_id=conversation_id)
     try:
-        if not req.question.strip():
-            logger.warning("Empty question provided", extra={"query_id": query_id, "conversation_id": conversation_id})
-            return JSONResponse(
-                {"error": "No question provided. Please ask a question to proceed.", "conversation_id": conversation_id},
-                status_code=400
-            )
-
-        logger.debug("Calling answer_question", extra={"query_id": query_id, "conversation_id": conversation_id})
+        # Empty, oversized and rate-limited questions are rejected by answer_question
+        logger.debug("Calling answer_question", query_id=query_id, conversation_id=conversation_id)
         try:
-            response = answer_question(req.question, req.conversation_id)
-            logger.info(f"Response: {response['answer'][:500]}...", extra={"query_id": query_id, "conversation_id": conversation_id})
+            response = await answer_question(req.question, conversation_id, client_id(request))
+            logger.debug("Response", answer=response['answer'], query_id=query_id, conversation_id=conversation_id)
             return JSONResponse(response)
+        except QuestionRejectedError as e:
+            return JSONResponse(
+                {"error": str(e), "conversation_id": conversation_id},
+                status_code=429 if e.kind == "rate_limited" else 400
+            )
         except Exception as e:
-            logger.error(f"Failed to process question: {str(e)}", extra={"query_id": query_id, "conversation_id": conversation_id})
+            logger.error("Failed to process question", error=str(e), query_id=query_id, conversation_id=conversation_id)
             return JSONResponse(
                 {"error": "Unable to process your question. Please try again or contact support.", "conversation_id": conversation_id},
                 status_code=500
             )
     except ValidationError as e:
-        logger.error(f"Validation error in ask_question: {str(e)}", extra={"query_id": query_id, "conversation_id": conversation_id})
+        logger.error("Validation error in ask_question", error=str(e), query_id=query_id, conversation_id=conversation_id)
         return JSONResponse(
             {"error": f"Invalid request payload: {str(e)}", "conversation_id": conversation_id},
             status_code=422
         )
     except Exception as e:
-        logger.critical(f"Critical error in ask_question: {str(e)}", extra={"query_id": query_id, "conversation_id": conversation_id})
+        logger.critical("Critical error in ask_question", error=str(e), query_id=query_id, conversation_id=conversation_id)
         return JSONResponse(
             {"error": "An unexpected error occurred. Please try again later or contact support.", "conversation_id": conversation_id},
             status_code=500
@@ -276,17 +295,44 @@ async def ask_question(request: Request, req: QuestionRequest):
 
 
 
+@app.post("/ask_stream")
+async def ask_question_stream(request: Request, req: QuestionRequest):
+    query_id = new_query_id()
+    conversation_id = req.conversation_id or new_conversation_id()
+    client = client_id(request)
+    logger.debug("Received streaming question", question=req.question, query_id=query_id, conversation_id=conversation_id)
+
+    async def event_stream():
+        # Each chunk is a "data:" event; a final "done" event carries the conversation ID.
+        # Rejected questions (empty, too long, rate-limited) get an "error" event with their kind.
+        try:
+            async for chunk in stream_answer(req.question, conversation_id, client):
+                yield f"data: {json.dumps({'token': chunk})}\n\n"
+        except QuestionRejectedError as e:
+            yield f"event: error\ndata: {json.dumps({'error': str(e), 'kind': e.kind})}\n\n"
+        except Exception as e:
+            logger.error("Failed to stream answer", error=str(e), query_id=query_id, conversation_id=conversation_id)
+            yield f"event: error\ndata: {json.dumps({'error': 'Unable to process your question. Please try again or contact support.'})}\n\n"
+        yield f"event: done\ndata: {json.dumps({'conversation_id': conversation_id})}\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
+
+
+
 @app.post("/clear_index")
 async def clear_index():
-    query_id = str(uuid.uuid4())
-    logger.info("Received clear index request", extra={"query_id": query_id, "conversation_id": "N/A"})
+    query_id = new_query_id()
+    logger.info("Received clear index request", query_id=query_id, conversation_id="N/A")
     try:
-        logger.debug("Attempting to clear Pinecone index", extra={"query_id": query_id, "conversation_id": "N/A"})
+        logger.debug("Attempting to clear Pinecone index", query_id=query_id, conversation_id="N/A")
         clear_pinecone_index()
-        logger.info("Index cleared successfully", extra={"query_id": query_id, "conversation_id": "N/A"})
+        clear_retrieval_cache()
+        logger.info("Index cleared successfully", query_id=query_id, conversation_id="N/A")
         return JSONResponse({"message": "Vector index cleared successfully!"})
     except Exception as e:
-        logger.error(f"Error clearing index: {str(e)}", extra={"query_id": query_id, "conversation_id": "N/A"})
+        logger.error("Error clearing index", error=str(e), query_id=query_id, conversation_id="N/A")
         return JSONResponse(
             {"error": "Failed to clear the index. Please try again or contact support."},
             status_code=500
@@ -1,4 +1,4 @@
-from langchain.prompts import PromptTemplate
+from langchain.prompts import ChatPromptTemplate
 
 fixed_system_prompt = """
 You are a modular customer support AI agent.  
@@ -22,11 +22,7 @@ You are designed to be **domain-independent**: The domain instructions will spec
 Never assume the industry yourself—always adapt based on domain instructions.  
 """
 
-rag_prompt = PromptTemplate.from_template(
-    fixed_system_prompt +
-    """
-{domain_instructions}
-
+response_rules = """
 Respond in English. Always respond in English, even if the context is in another language. Translate any necessary information from the context to English.
 
 **Greeting Rules**:
@@ -43,8 +39,18 @@ Respond in English. Always respond in English, even if the context is in another
 - For requests outside scope (e.g., giving professional advice like medical diagnoses), politely say you cannot assist and suggest appropriate actions (e.g., contact a doctor or emergency services).
 - When asked for "contact information," include all available contact details (e.g., phone number, email address) from the context in a clear, formatted manner.
 - Use the chat history to provide context-aware responses. If the chat history contains relevant prior questions or answers, reference them explicitly to maintain conversation flow (e.g., "As you mentioned earlier about [topic], ...").
+"""
 
-Context:
+# Everything static (system prompt, rules, per-deployment domain instructions) goes first so
+# the provider's prompt prefix cache can reuse it; per-request variables come last.
+# OpenAI only caches prompts of 1024+ tokens: the fixed part is ~700 tokens, so the system
+# message reaches the threshold only with a few hundred tokens of domain instructions.
+rag_prompt = ChatPromptTemplate.from_messages([
+    ("system", fixed_system_prompt + response_rules + """
+Domain Instructions:
+{domain_instructions}
+"""),
+    ("human", """Context:
 {context}
 
 Chat History:
@@ -52,7 +58,5 @@ Chat History:
 
 User Question:
 {question}
-
-Response:
-"""
-)
\ No newline at end of file
+"""),
+])
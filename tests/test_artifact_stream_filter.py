@@ -0,0 +1,59 @@
+import random
+
+import pytest
+
+from artifacts import ArtifactStreamFilter, strip_artifacts
+
+
+# Fragments that exercise every boundary the filter holds text back at
+FRAGMENTS = [
+    "Final Answer:", "final answer:", "FINAL ANSWER: ", "Final", " Answer", "Final Answer",
+    "[email protected]", "[EMAIL PROTECTED]", "[email", " protected]", "[", "]",
+    "\n", "\n\n", " ", "  ", "\t", "\r\n",
+    "Hello", "Our hours are 9-5.", "x", ":",
+]
+
+
+def stream_through_filter(text: str, cuts: list) -> str:
+    stream_filter = ArtifactStreamFilter()
+    out = []
+    start = 0
+    for end in cuts + [len(text)]:
+        out.append(stream_filter.feed(text[start:end]))
+        start = end
+    out.append(stream_filter.flush())
+    return "".join(out)
+
+
+def random_chunking(rng: random.Random, text: str) -> list:
+    if not text:
+        return []
+    return sorted(rng.sample(range(len(text)), rng.randint(0, min(len(text), 8))))
+
+
+@pytest.mark.parametrize("text", [
+    "",
+    "   ",
+    "Final Answer: Our hours are 9-5.",
+    "  final answer:\n\nHello",
+    "Thinking...\nFinal Answer: Email us at [email protected].",
+    "Contact [email protected] or [email protected]",
+    "Final",
+    "Hello\n  Final Answer:  \n",
+    "Price: [email",
+])
+def test_matches_strip_artifacts_for_every_chunking(text):
+    expected = strip_artifacts(text, "test")
+    for cut in range(len(text) + 1):
+        assert stream_through_filter(text, [cut]) == expected
+    assert stream_through_filter(text, list(range(1, len(text)))) == expected
+
+
+def test_matches_strip_artifacts_on_random_inputs():
+    rng = random.Random(0)
+    for _ in range(5000):
+        text = "".join(rng.choice(FRAGMENTS) for _ in range(rng.randint(0, 12)))
+        expected = strip_artifacts(text, "test")
+        for _ in range(4):
+            cuts = random_chunking(rng, text)
+            assert stream_through_filter(text, cuts) == expected, (text, cuts)
@@ -0,0 +1,64 @@
+import asyncio
+import time
+
+from batching import MicroBatcher
+
+
+DISPATCH_SECONDS = 0.3
+
+
+def test_batches_overlap_while_a_dispatch_is_in_flight():
+    dispatched = []
+
+    async def dispatch(items):
+        dispatched.append(list(items))
+        await asyncio.sleep(DISPATCH_SECONDS)
+        return [item * 2 for item in items]
+
+    async def timed_submit(batcher, item, delay):
+        await asyncio.sleep(delay)
+        start = time.monotonic()
+        result = await batcher.submit(item)
+        return result, time.monotonic() - start
+
+    async def run():
+        batcher = MicroBatcher("test", dispatch, max_size=16, max_wait=0.01)
+        return await asyncio.gather(timed_submit(batcher, 1, 0), timed_submit(batcher, 2, DISPATCH_SECONDS / 3))
+
+    (first, first_elapsed), (second, second_elapsed) = asyncio.run(run())
+    assert (first, second) == (2, 4)
+    assert dispatched == [[1], [2]]
+    # The second batch must not wait for the first dispatch to finish
+    assert second_elapsed < DISPATCH_SECONDS * 1.5
+
+
+def test_failed_dispatch_fails_only_its_batch():
+    async def dispatch(items):
+        if items == ["bad"]:
+            raise RuntimeError("embedding request failed")
+        return items
+
+    async def run():
+        batcher = MicroBatcher("test", dispatch, max_size=16, max_wait=0)
+        bad = await asyncio.gather(batcher.submit("bad"), return_exceptions=True)
+        good = await batcher.submit("good")
+        return bad[0], good
+
+    bad, good = asyncio.run(run())
+    assert isinstance(bad, RuntimeError)
+    assert good == "good"
+
+
+def test_idle_batcher_dispatches_without_waiting():
+    async def dispatch(items):
+        return items
+
+    async def run():
+        batcher = MicroBatcher("test", dispatch, max_size=16, max_wait=1.0)
+        start = time.monotonic()
+        result = await batcher.submit("only")
+        return result, time.monotonic() - start
+
+    result, elapsed = asyncio.run(run())
+    assert result == "only"
+    assert elapsed < 0.5